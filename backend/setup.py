@@ -50,6 +50,9 @@ setup_args = dict(
     ],
 
     extras_require = {
+        'vips': [
+            'pyvips',
+        ],
         'test': [
             'pytest',
             'pytest-cov>=2.6.1',
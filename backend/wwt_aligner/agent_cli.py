@@ -9,10 +9,7 @@ import argparse
 import json
 import logging
 import os.path
-import shutil
 import sys
-import tempfile
-import time
 
 __all__ = ['entrypoint']
 
@@ -27,6 +24,53 @@ def die(msg):
 def warn(msg):
     print('warning:', msg, file=sys.stderr)
 
+def positive_int(text):
+    """
+    An argparse ``type`` for integers that must be at least 1.
+    """
+    try:
+        value = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid integer value: {text!r}')
+
+    if value < 1:
+        raise argparse.ArgumentTypeError(f'must be at least 1, got {value}')
+
+    return value
+
+
+class CachedParser(argparse.ArgumentParser):
+    """
+    An ArgumentParser that reuses one formatter for argument validation.
+
+    Every call to ``add_argument()`` asks for a fresh help formatter just to
+    sanity-check the new action's metavar (and, on newer Pythons, its help
+    text). Formatter construction probes the terminal and environment for
+    color support, which adds up given how many arguments we declare on every
+    launch. That validation doesn't mutate the formatter, so we can hand back
+    a cached instance while ``add_argument()`` is running. All other callers
+    (help and usage generation) still get a fresh formatter.
+    """
+    _validation_formatter = None
+    _in_add_argument = False
+
+    def add_argument(self, *args, **kwargs):
+        self._in_add_argument = True
+        try:
+            return super().add_argument(*args, **kwargs)
+        finally:
+            self._in_add_argument = False
+
+    def _get_formatter(self, *args, **kwargs):
+        # This is a private argparse method whose signature may change between
+        # Python versions, so pass through whatever we're given.
+        if not self._in_add_argument:
+            return super()._get_formatter(*args, **kwargs)
+
+        if self._validation_formatter is None:
+            self._validation_formatter = super()._get_formatter(*args, **kwargs)
+        return self._validation_formatter
+
 
 # The agent is generally expected to run inside a Docker container. In order to
 # be able to do its input and output, then, its container needs to be set up
@@ -51,22 +95,26 @@ def warn(msg):
 ARGS_PROTOCOL_VERSION = 1
 
 class ArgPiece(object):
-    text = None
-    "The text of this argument piece."
-
-    incomplete = False
-    """If true, the subsequent arg piece should be concatenated to this one
-    without a space. This allows us to handle arguments of the form
-    `--path=./somepath.txt`."""
-
-    path_pre_exists = False
-    """If true, this piece is a filesystem path and it should exist before the
-    program starts running."""
+    """
+    One piece of a command-line argument, as communicated to the launcher.
 
-    path_created = False
-    """If true, this piece is a filesystem path that the program will create
-    during its exection. Therefore its containing directory should be mounted
-    read-write in the Docker container."""
+    Attributes
+    ----------
+    text : str
+        The text of this argument piece.
+    incomplete : bool
+        If true, the subsequent arg piece should be concatenated to this one
+        without a space. This allows us to handle arguments of the form
+        `--path=./somepath.txt`.
+    path_pre_exists : bool
+        If true, this piece is a filesystem path and it should exist before
+        the program starts running.
+    path_created : bool
+        If true, this piece is a filesystem path that the program will create
+        during its exection. Therefore its containing directory should be
+        mounted read-write in the Docker container.
+    """
+    __slots__ = ('text', 'incomplete', 'path_pre_exists', 'path_created')
 
     def __init__(self, text, incomplete=False, path_pre_exists=False, path_created=False):
         self.text = str(text)
@@ -90,15 +138,21 @@ class ArgPiece(object):
 
 
 class PublishedPort(object):
-    host_ip = None
-    """The IP address specification for the interface on the host that should listen
-    for connections. If unspecified, defaults to the local loopback interface."""
-
-    host_port = None
-    "The port number on the host side."
+    """
+    A network port that the launcher should publish from the container.
 
-    container_port = None
-    "The port number on the container side."
+    Attributes
+    ----------
+    host_ip : str or None
+        The IP address specification for the interface on the host that
+        should listen for connections. If unspecified, defaults to the local
+        loopback interface.
+    host_port : int
+        The port number on the host side.
+    container_port : int
+        The port number on the container side.
+    """
+    __slots__ = ('host_ip', 'host_port', 'container_port')
 
     def __init__(self, host_port, container_port, host_ip=None):
         self.host_ip = host_ip
@@ -155,7 +209,9 @@ class ArgsProtocolBuilder(object):
             'pieces': [p.as_json() for p in self.pieces],
             'published_ports': [p.as_json() for p in self.ports],
         }
-        json.dump(data, fp, ensure_ascii=False, indent=2, sort_keys=True)
+        # This is consumed by the launcher, not a human, so skip the
+        # pretty-printing.
+        json.dump(data, fp, ensure_ascii=False, separators=(',', ':'))
 
 
 # "diagnostic" subcommands
@@ -236,6 +292,19 @@ def go_getparser(parser):
         dest = 'work_path',
         help = 'Create this directory for work files; do not delete them after finishing up',
     )
+    parser.add_argument(
+        '--index-cache',
+        dest = 'index_cache_path',
+        help = 'Reuse Astrometry.Net indexes saved in this directory, and save new ones there',
+    )
+    parser.add_argument(
+        '--reference-downsample',
+        dest = 'reference_downsample',
+        type = positive_int,
+        default = 1,
+        metavar = 'FACTOR',
+        help = 'Downsample the reference FITS images by this factor before finding sources in them',
+    )
     parser.add_argument(
         'rgb_path',
         metavar = 'RGB-PATH',
@@ -264,6 +333,13 @@ def go_analyze_args(builder, settings):
         builder.add_arg('--workdir=', incomplete=True)
         builder.add_path_arg(settings.work_path, created=True)
 
+    if settings.reference_downsample != 1:
+        builder.add_arg(f'--reference-downsample={settings.reference_downsample}')
+
+    if settings.index_cache_path:
+        builder.add_arg('--index-cache=', incomplete=True)
+        builder.add_path_arg(settings.index_cache_path, created=True)
+
     builder.add_path_arg(settings.rgb_path, pre_exists=True)
 
     for p in settings.fits_paths:
@@ -271,6 +347,8 @@ def go_analyze_args(builder, settings):
 
 
 def go_impl(settings):
+    import shutil
+    import tempfile
     from .driver import go
 
     if settings.work_path is not None:
@@ -287,6 +365,8 @@ def go_impl(settings):
             tile_path = settings.tile_path,
             work_dir = work_dir,
             anet_bin_prefix = settings.anet_bin_prefix,
+            index_cache_dir = settings.index_cache_path,
+            reference_downsample = settings.reference_downsample,
         )
     except KeyboardInterrupt:
         print('\nfatal error: the alignment process was interrupted', file=sys.stderr)
@@ -340,6 +420,80 @@ def serve_wtml_impl(settings):
 
 # The CLI driver:
 
+# Map from subcommand name to its (getparser, impl, analyze_args) functions,
+# discovered from the naming convention used above and sorted by name, so that
+# help output is stable. The latter two may be None.
+
+SUBCOMMANDS = {
+    py_name[:-10].replace('_', '-'): (
+        value,
+        globals().get(py_name[:-10] + '_impl'),
+        globals().get(py_name[:-10] + '_analyze_args'),
+    )
+    for py_name, value in sorted(globals().items())
+    if py_name.endswith('_getparser')
+}
+
+# The launcher inserts these "meta" options before the subcommand name when it
+# invokes us. They're not meant for humans, so rather than teaching argparse
+# about them, we peel them off by hand.
+
+META_PATH_OPTIONS = {
+    '--x-host-path': 'host_paths',
+    '--x-container-path': 'container_paths',
+}
+
+def peel_meta_args(args):
+    """
+    Split the launcher's meta options off of the front of an argument list.
+
+    Parameters
+    ----------
+    args : list of str
+      The arguments on the command line, without ``argv[0]``.
+
+    Returns
+    -------
+    A tuple ``(meta, rest)``, where ``meta`` is a dict of the settings
+    specified by the meta options and ``rest`` is a list of the remaining
+    arguments, starting with the first one that isn't a meta option.
+    """
+    meta = {
+        'analyze_args_mode': False,
+        'host_paths': None,
+        'container_paths': None,
+    }
+    i = 0
+
+    while i < len(args):
+        arg = args[i]
+
+        if arg == '--x-analyze-args-mode':
+            meta['analyze_args_mode'] = True
+            i += 1
+            continue
+
+        name, eq, value = arg.partition('=')
+        key = META_PATH_OPTIONS.get(name)
+
+        if key is None:
+            break
+
+        if eq:
+            i += 1
+        elif i + 1 < len(args):
+            value = args[i + 1]
+            i += 2
+        else:
+            die(f'option {name} requires a value')
+
+        if meta[key] is None:
+            meta[key] = []
+        meta[key].append(value)
+
+    return meta, args[i:]
+
+
 def entrypoint(args=None):
     """The entrypoint for the \"wwt-aligner\" command-line interface.
 
@@ -351,43 +505,43 @@ def entrypoint(args=None):
       parameter.
 
     """
-    # Set up the subcommands from globals()
+    if args is None:
+        args = sys.argv[1:]
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument(
-        '--x-analyze-args-mode',
-        dest = 'analyze_args_mode',
-        action = 'store_true',
-        help = argparse.SUPPRESS,
-    )
-    parser.add_argument(
-        '--x-host-path',
-        dest = 'host_paths',
-        action = 'append',
-        help = argparse.SUPPRESS,
-    )
-    parser.add_argument(
-        '--x-container-path',
-        dest = 'container_paths',
-        action = 'append',
-        help = argparse.SUPPRESS,
-    )
-    subparsers = parser.add_subparsers(dest="subcommand")
-    commands = set()
-
-    for py_name, value in globals().items():
-        if py_name.endswith('_getparser'):
-            cmd_name = py_name[:-10].replace('_', '-')
-            subparser = subparsers.add_parser(cmd_name)
-            subparser.add_argument(
-                '--log',
-                dest = 'log_level',
-                default = 'default',
-                choices = ['default', 'debug', 'info', 'warning'],
-                help = 'The amount of logging information to emit',
-            )
-            value(subparser)
-            commands.add(cmd_name)
+    meta, args = peel_meta_args(list(args))
+
+    # In args-analysis mode, the launcher is only interested in one
+    # subcommand, so if we can identify it up front, don't bother setting up
+    # parsers for any of the others. Once the meta options are gone, the only
+    # global option is `--help`, so the first non-option argument should be
+    # the subcommand name.
+
+    only_cmd = None
+
+    if meta['analyze_args_mode']:
+        only_cmd = next((a for a in args if not a.startswith('-')), None)
+
+        if only_cmd not in SUBCOMMANDS:
+            only_cmd = None
+
+    # Set up the subcommands
+
+    parser = CachedParser()
+    subparsers = parser.add_subparsers(dest="subcommand", parser_class=CachedParser)
+
+    for cmd_name, (getparser, _impl, _aa) in SUBCOMMANDS.items():
+        if only_cmd is not None and cmd_name != only_cmd:
+            continue
+
+        subparser = subparsers.add_parser(cmd_name)
+        subparser.add_argument(
+            '--log',
+            dest = 'log_level',
+            default = 'default',
+            choices = ['default', 'debug', 'info', 'warning'],
+            help = 'The amount of logging information to emit',
+        )
+        getparser(subparser)
 
     # What did we get?
     #
@@ -395,42 +549,47 @@ def entrypoint(args=None):
 
     settings = parser.parse_args(args)
 
-    # Set up the logging
-
-    if settings.log_level == 'default':
-        log_level = logging.INFO
-        log_format = '%(message)s'
-        log_stream = sys.stdout
-    else:
-        log_level = getattr(logging, settings.log_level.upper(), None)
-        if not isinstance(log_level, int):
-            die(f'invalid log level "{settings.log_level}"')
+    for key, value in meta.items():
+        setattr(settings, key, value)
 
-        log_format = '%(asctime)s: %(message)s'
-        log_stream = sys.stderr
+    # Set up the logging. In args-analysis mode, our stdout is the JSON output,
+    # so don't risk contaminating it.
 
-    sh = logging.StreamHandler(stream=log_stream)
-    sh.setLevel(log_level)
-    sh.setFormatter(logging.Formatter(log_format, datefmt='%H:%M:%S'))
-    logger.setLevel(log_level)
-    logger.addHandler(sh)
+    if not settings.analyze_args_mode:
+        if settings.log_level == 'default':
+            log_level = logging.INFO
+            log_format = '%(message)s'
+            log_stream = sys.stdout
+        else:
+            log_level = getattr(logging, settings.log_level.upper(), None)
+            if not isinstance(log_level, int):
+                die(f'invalid log level "{settings.log_level}"')
+
+            log_format = '%(asctime)s: %(message)s'
+            log_stream = sys.stderr
+
+        sh = logging.StreamHandler(stream=log_stream)
+        sh.setLevel(log_level)
+        sh.setFormatter(logging.Formatter(log_format, datefmt='%H:%M:%S'))
+        logger.setLevel(log_level)
+        logger.addHandler(sh)
 
     # Next, look into the subcommand
 
     if settings.subcommand is None:
         print('Run me with --help for help. Allowed subcommands are:')
         print()
-        for cmd in sorted(commands):
+        for cmd in SUBCOMMANDS:
             print('   ', cmd)
         return
 
-    py_name = settings.subcommand.replace('-', '_')
+    _getparser, impl, aa = SUBCOMMANDS[settings.subcommand]
 
     if not settings.analyze_args_mode:
+        import time
         logger.debug('wwt-aligner agent: starting at %s', time.strftime("%Y-%m-%dT%H:%M:%SZ"))
 
         # Just Do It.
-        impl = globals().get(py_name + '_impl')
         if impl is None:
             die('no such subcommand "{}"'.format(settings.subcommand))
 
@@ -438,7 +597,6 @@ def entrypoint(args=None):
         sys.exit(rv)
     else:
         # We're in args-analysis mode.
-        aa = globals().get(py_name + '_analyze_args')
         if aa is None:
             die('no such (analyzable) subcommand "{}"'.format(settings.subcommand))
 
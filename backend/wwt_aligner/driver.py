@@ -12,15 +12,21 @@ __all__ = [
 ]
 
 from astropy.io import fits
-from astropy.table import Table
 from astropy.wcs import WCS
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass
+from functools import partial
+import hashlib
+import logging
 import math
 import numpy as np
 import os.path
-from PIL import Image as pil_image
+from PIL import Image as pil_image, ImageMode
 from pyavm import AVM
 import sep
+import shutil
 import subprocess
 import sys
 from toasty.builder import Builder
@@ -28,6 +34,13 @@ from toasty.image import ImageLoader
 
 from . import logger
 
+ANET_PRESET_MIN = -5
+ANET_PRESET_MAX = 19
+
+# Preset P applies to image sizes of at least 2**((P - 5) / 2) degrees. These
+# are the thresholds for all presets above the minimum.
+ANET_PRESET_EDGES = 2.0 ** ((np.arange(ANET_PRESET_MIN + 1, ANET_PRESET_MAX + 1) - 5) / 2)
+
 def image_size_to_anet_preset(size_deg):
     """
     Get an astrometry.net "preset" size from an image size. Docs say:
@@ -37,10 +50,39 @@ def image_size_to_anet_preset(size_deg):
     4 => ~24 arcmin
 
     etc. Our "size_deg" parameter is the diagonal size of the image,
-    which offsets the calculation by one step or so. The minimum
-    allowed preset is -5.
+    which offsets the calculation by one step or so. The allowed
+    presets range from -5 to 19.
     """
-    return max(-5, int(np.floor(5 + 2 * math.log2(size_deg))))
+    return ANET_PRESET_MIN + int(np.searchsorted(ANET_PRESET_EDGES, size_deg, side='right'))
+
+
+def angular_separation_deg(ra1, dec1, ra2, dec2):
+    """
+    Compute the angular separation between two sky positions, all in degrees,
+    using the haversine formula. Inputs are scalars; the result is a plain
+    float.
+    """
+    ra1, dec1, ra2, dec2 = map(math.radians, (ra1, dec1, ra2, dec2))
+    sin_ddec = math.sin(0.5 * (dec2 - dec1))
+    sin_dra = math.sin(0.5 * (ra2 - ra1))
+    h = sin_ddec**2 + math.cos(dec1) * math.cos(dec2) * sin_dra**2
+    return math.degrees(2 * math.asin(math.sqrt(min(max(h, 0.0), 1.0))))
+
+
+def equatorial_axes(wcs):
+    """
+    Get the indices ``(ra_axis, dec_axis)`` of the world axes of *wcs*,
+    raising an exception if its celestial frame isn't equatorial. Indices
+    need RA/Dec positions, and the plain-array WCS API will happily return
+    other frames in whatever axis order the header uses.
+    """
+    lng, lat = wcs.wcs.lng, wcs.wcs.lat
+    ctype = list(wcs.wcs.ctype)
+
+    if lng < 0 or lat < 0 or not ctype[lng].startswith('RA') or not ctype[lat].startswith('DEC'):
+        raise ValueError(f'image WCS is not equatorial (axis types: {ctype!r})')
+
+    return lng, lat
 
 
 @dataclass
@@ -51,38 +93,87 @@ class FitsInfo(object):
     height_pixels: int = 0
     bgsub_data: np.array = None
     sep_objects: np.array = None
-    wcs_objects: Table = None
+    wcs_objects: fits.BinTableHDU = None
+    wcs: WCS = None
 
 @dataclass
 class ExtractionConfig(object):
     bg_box_size: int = 32
+    "The minimum size of the SEP background boxes, in pixels."
+
+    bg_box_count: int = 64
+    """For large images, grow the background boxes so that there are about this
+    many of them along each axis."""
+
     bg_filter_size: int = 3
     bg_filter_threshold: float = 0.0
     source_threshold: int = 10
 
+    source_min_area: int = 7
+    "The minimum number of pixels in a detected source."
+
+    source_filter: bool = False
+    """Whether to apply SEP's default matched filter before detection. We only
+    need bright sources for indexing, so we skip the convolution by default."""
+
+    source_clean: bool = False
+    "Whether to run SEP's cleaning pass on detections."
+
+    deblend_contrast: float = 1.0
+    "SEP's deblending contrast; the default of 1.0 disables deblending."
+
+    max_source_count: int = 2000
+    """Keep at most this many of the brightest detected sources for indexing.
+    Zero means no limit."""
+
+    extract_pixstack: int = 1000000
+    "The size of SEP's pixel buffer for source extraction."
+
+    sub_object_limit: int = 2048
+    "SEP's limit on the number of sub-objects when deblending a detection."
+
+
 def source_extract_fits(
     fits_path,
     log_prefix='',
+    keep_image=False,
+    downsample=1,
 ):
+    """
+    Find sources in a reference FITS image.
+
+    The background-subtracted image data and raw SEP detections are only
+    retained in the returned FitsInfo if *keep_image* is true, since the image
+    can be very large. Note that they are in downsampled pixels if
+    *downsample* is used.
+
+    If *downsample* is greater than 1, the image is block-averaged by that
+    factor along each axis before sourcefinding, which is much faster for big
+    images. Positions in the object table are still relative to the
+    full-resolution image.
+    """
+    if downsample < 1:
+        raise ValueError(f'downsample factor must be at least 1, got {downsample!r}')
+
     info = FitsInfo()
     config = ExtractionConfig()
 
-    # Figure out the HDU to use, and read data + WCS
+    # Figure out the HDU to use, and read data + WCS. We make the decision
+    # based only on the headers, so that we don't read in the data of HDUs
+    # that we're not going to use.
 
     data = None
 
-    with fits.open(fits_path) as hdul:
+    with fits.open(fits_path, memmap=True) as hdul:
         for hdu_num, hdu in enumerate(hdul):
-            logger.debug('%sconsidering HDU #%d; data shape %r', log_prefix, hdu_num, hdu.shape)
-
-            if hdu.data is None:
-                continue  # reject: no data
-
-            if hasattr(hdu, 'columns'):
+            if not hdu.is_image:
+                logger.debug('%sskipping HDU #%d; not an image', log_prefix, hdu_num)
                 continue  # reject: tabular
 
+            logger.debug('%sconsidering HDU #%d; data shape %r', log_prefix, hdu_num, hdu.shape)
+
             if len(hdu.shape) < 2:
-                continue  # reject: not at least 2D
+                continue  # reject: no data, or not at least 2D
 
             # OK, it looks like this the HDU we want!
             wcs = WCS(hdu)
@@ -91,33 +182,50 @@ def source_extract_fits(
             break
 
     assert data is not None, 'failed to find a usable image HDU'
-    data = data.byteswap(inplace=True).newbyteorder()
+    ra_axis, dec_axis = equatorial_axes(wcs)
 
-    # Get some useful housekeeping data
+    # SEP needs native-endian data, and works in single precision internally,
+    # so hand it native float32 data up front rather than paying for wider
+    # types in every pass. FITS data are big-endian, so this is usually a
+    # byteswap too, but numpy does the swap, the cast, and the copy out of the
+    # file buffer in one pass. This also lets us handle integer images, which
+    # SEP doesn't accept for all widths.
+    data = data.astype(np.float32, copy=False)
 
     info.width_pixels = width
     info.height_pixels = height
+    info.wcs = wcs
 
-    midx = width // 2
-    midy = height // 2
-    coords = wcs.pixel_to_world(
-        [midx, midx + 1, 0, width, 0, width],
-        [midy, midy + 1, 0, height, midy, midy],
-    )
+    # Downsample, if requested. The index doesn't need especially precise
+    # source positions, and this reduces the work for SEP by the square of
+    # the factor.
 
-    info.large_scale_deg = coords[2].separation(coords[3]).deg
-    logger.debug('%slarge scale for this image: %e deg', log_prefix, info.large_scale_deg)
-    info.width_deg = coords[4].separation(coords[5]).deg
-    logger.debug('%scharacteristic width for this image: %e deg', log_prefix, info.width_deg)
+    ds = downsample
+
+    if ds > 1:
+        ds_height = height // ds
+        ds_width = width // ds
+        data = data[:ds_height * ds, :ds_width * ds]
+        data = data.reshape(ds_height, ds, ds_width, ds).mean(axis=(1, 3))
+        logger.debug('%sdownsampled by %d to shape %r', log_prefix, ds, data.shape)
 
     # Use SEP to find sources
 
     logger.info('%sFinding sources ...', log_prefix)
 
+    # On big images, the default box size leads to a huge number of boxes,
+    # which dominates the runtime, so scale it with the image.
+    bg_box_size = max(config.bg_box_size, int(np.sqrt(data.size) / config.bg_box_count))
+    logger.debug('%sSEP background box size: %d', log_prefix, bg_box_size)
+
+    # Size SEP's internal buffers up front, rather than failing on busy images.
+    sep.set_extract_pixstack(config.extract_pixstack)
+    sep.set_sub_object_limit(config.sub_object_limit)
+
     bkg = sep.Background(
         data,
-        bw = config.bg_box_size,
-        bh = config.bg_box_size,
+        bw = bg_box_size,
+        bh = bg_box_size,
         fw = config.bg_filter_size,
         fh = config.bg_filter_size,
         fthresh = config.bg_filter_threshold,
@@ -125,27 +233,83 @@ def source_extract_fits(
     logger.debug('%sSEP background level: %e', log_prefix, bkg.globalback)
     logger.debug('%sSEP background rms: %e', log_prefix, bkg.globalrms)
     bkg.subfrom(data)
-    info.bgsub_data = data
 
-    info.sep_objects = sep.extract(data, config.source_threshold, err=bkg.globalrms)
-    logger.debug('%sSEP object count: %d', log_prefix, len(info.sep_objects))
+    extract_kwargs = {}
+
+    if not config.source_filter:
+        extract_kwargs['filter_kernel'] = None
+
+    objects = sep.extract(
+        data,
+        config.source_threshold,
+        err = bkg.globalrms,
+        minarea = config.source_min_area,
+        clean = config.source_clean,
+        deblend_cont = config.deblend_contrast,
+        **extract_kwargs
+    )
+    logger.debug('%sSEP object count: %d', log_prefix, len(objects))
+
+    # Indexing and solving both scale steeply with catalog size, and only the
+    # brightest sources are useful, so keep just the top sources by flux.
+
+    if config.max_source_count and len(objects) > config.max_source_count:
+        order = np.argsort(objects['flux'])[::-1][:config.max_source_count]
+        objects = objects[order]
+        logger.debug('%skept the brightest %d objects', log_prefix, len(objects))
 
-    coords = wcs.pixel_to_world(info.sep_objects['x'], info.sep_objects['y'])
-    info.wcs_objects = Table(
-        [coords.ra.deg, coords.dec.deg, info.sep_objects['flux']],
-        names=('RA', 'DEC', 'FLUX')
+    if keep_image:
+        info.bgsub_data = data
+        info.sep_objects = objects
+
+    # Convert to world coordinates. We also need some housekeeping coordinates
+    # to characterize the image scale, and it's cheaper to get them in the
+    # same WCS call as the objects.
+    #
+    # We use the plain-array API, since constructing SkyCoords is expensive
+    # and all we need are degrees.
+    #
+    # If we downsampled, map the positions back to full-resolution pixels:
+    # downsampled pixel 0 is centered between full-resolution pixels 0 and
+    # ds - 1.
+
+    midx = width // 2
+    midy = height // 2
+    n_hk = 6
+    obj_x = ds * objects['x'] + 0.5 * (ds - 1)
+    obj_y = ds * objects['y'] + 0.5 * (ds - 1)
+    world = wcs.pixel_to_world_values(
+        np.concatenate(([midx, midx + 1, 0, width, 0, width], obj_x)),
+        np.concatenate(([midy, midy + 1, 0, height, midy, midy], obj_y)),
     )
+    ra, dec = world[ra_axis], world[dec_axis]
+
+    info.large_scale_deg = angular_separation_deg(ra[2], dec[2], ra[3], dec[3])
+    logger.debug('%slarge scale for this image: %e deg', log_prefix, info.large_scale_deg)
+    info.width_deg = angular_separation_deg(ra[4], dec[4], ra[5], dec[5])
+    logger.debug('%scharacteristic width for this image: %e deg', log_prefix, info.width_deg)
+
+    # Build the table HDU directly, since an intermediate astropy Table would
+    # just copy the columns an extra time. Single precision is plenty for the
+    # fluxes, which are only used for ordering, but positions stay in double
+    # precision, since float32 RAs are only good to about 0.1 arcsec.
+
+    info.wcs_objects = fits.BinTableHDU.from_columns([
+        fits.Column(name='RA', format='D', array=ra[n_hk:]),
+        fits.Column(name='DEC', format='D', array=dec[n_hk:]),
+        fits.Column(name='FLUX', format='E', array=objects['flux']),
+    ])
 
     # All done!
     return info
 
 
-def plot_fits_sources(fits_path):
+def plot_fits_sources(fits_path, downsample=1):
     import matplotlib.pyplot as plt
-    from matplotlib.patches import Ellipse
+    from matplotlib.collections import EllipseCollection
 
     try:
-        info = source_extract_fits(fits_path)
+        info = source_extract_fits(fits_path, keep_image=True, downsample=downsample)
     except Exception as e:
         raise Exception(f'could not extract sources from `{fits_path}`') from e
 
@@ -158,27 +322,36 @@ def plot_fits_sources(fits_path):
     # This stuff derived from the SEP documentation.
 
     fig, ax = plt.subplots()
-    m = np.mean(info.bgsub_data)
-    s = np.std(info.bgsub_data)
+
+    # The color scale only needs to be approximate, so base it on a sparse
+    # sample of the pixels rather than making passes over the whole image.
+    sample = info.bgsub_data.ravel()[::max(1, info.bgsub_data.size // 1000000)]
+    vmin, vmax = np.percentile(sample, [1, 99])
+
     im = ax.imshow(
         info.bgsub_data,
         interpolation = 'nearest',
         cmap = 'gray',
-        vmin = m - s,
-        vmax = m + s,
+        vmin = vmin,
+        vmax = vmax,
         origin='lower',
     )
 
-    for i in range(len(info.sep_objects)):
-        e = Ellipse(
-            xy = (info.sep_objects['x'][i], info.sep_objects['y'][i]),
-            width = 6 * info.sep_objects['a'][i],
-            height = 6 * info.sep_objects['b'][i],
-            angle = info.sep_objects['theta'][i] * 180. / np.pi,
-        )
-        e.set_facecolor('none')
-        e.set_edgecolor('red')
-        ax.add_artist(e)
+    # Draw all of the ellipses as one collection, since adding an artist per
+    # source gets very slow for dense fields.
+
+    objects = info.sep_objects
+    ellipses = EllipseCollection(
+        6 * objects['a'],
+        6 * objects['b'],
+        objects['theta'] * 180. / np.pi,
+        units = 'xy',
+        offsets = np.column_stack((objects['x'], objects['y'])),
+        transOffset = ax.transData,
+        facecolors = 'none',
+        edgecolors = 'red',
+    )
+    ax.add_collection(ellipses)
 
     fig.tight_layout()
     img_path = os.path.splitext(fits_path)[0] + '_sources.png'
@@ -186,6 +359,43 @@ def plot_fits_sources(fits_path):
     logger.debug('saved sources image to `%s`', img_path)
 
 
+def run_and_log(
+    argv,
+    log_path,
+    output = None,
+    label = None,
+    log_prefix = '',
+):
+    """
+    Run a command, streaming its combined stdout and stderr into the debug log
+    as it arrives and teeing it into the file *log_path*. If *output* is not
+    None, each decoded line is also appended to it; pass a bounded
+    ``collections.deque`` to keep the tail in memory for error reporting.
+    Raises ``subprocess.CalledProcessError`` if the command fails.
+    """
+    if label is None:
+        label = os.path.basename(argv[0])
+
+    with open(log_path, 'wb') as log:
+        with subprocess.Popen(
+            argv,
+            stdout = subprocess.PIPE,
+            stderr = subprocess.STDOUT,
+            shell = False,
+        ) as proc:
+            for line in proc.stdout:
+                log.write(line)
+                line = line.decode('utf-8', errors='replace').rstrip()
+
+                if output is not None:
+                    output.append(line)
+
+                logger.debug('%s  %s: %s', log_prefix, label, line)
+
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, argv)
+
+
 def index_extracted_image(
     objects_fits,
     index_fits,
@@ -212,37 +422,48 @@ def index_extracted_image(
         '-S', 'FLUX',
         '-P', str(image_size_to_anet_preset(extraction_info.large_scale_deg)),
     ]
-    logger.debug('%sindex command: %s', log_prefix, ' '.join(argv))
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('%sindex command: %s', log_prefix, ' '.join(argv))
 
     logger.info('%sGenerating Astrometry.Net index ...', log_prefix)
+    index_output = deque(maxlen=200)
 
-    with open(index_log, 'wb') as log:
-        subprocess.check_call(
+    try:
+        run_and_log(
             argv,
-            stdout = log,
-            stderr = subprocess.STDOUT,
-            shell = False,
+            index_log,
+            output = index_output,
+            label = 'build-astrometry-index',
+            log_prefix = log_prefix,
         )
+    except Exception:
+        logger.warning('%sOutput from build-astrometry-index:', log_prefix)
+
+        for line in index_output:
+            logger.warning('%s  %s', log_prefix, line)
+
+        raise
 
 
 def plot_index(
     fits_path,
     anet_bin_prefix = '',
+    downsample = 1,
 ):
     from astrometry.plot.plotstuff import Plotstuff
-    import shutil
     import tempfile
 
     # Sourcefind ...
 
     try:
-        info = source_extract_fits(fits_path)
+        info = source_extract_fits(fits_path, downsample=downsample)
     except Exception as e:
         raise Exception(f'could not extract sources from `{fits_path}`') from e
 
     work_dir = tempfile.mkdtemp()
     objects_fits = os.path.join(work_dir, f'objects.fits')
-    info.wcs_objects.write(objects_fits, format='fits', overwrite=True)
+    info.wcs_objects.writeto(objects_fits, overwrite=True)
     index_fits = os.path.join(work_dir, f'index.fits')
     index_log = os.path.join(work_dir, f'build-index.log')
 
@@ -263,17 +484,18 @@ def plot_index(
 
     # Plot!
 
-    with fits.open(fits_path) as hdul:
-        hdu = hdul[0]  # haack
-        wcs = WCS(hdu.header)
-        height, width = hdu.shape[-2:]
-        midx = width // 2
-        midy = height // 2
-        coords = wcs.pixel_to_world(
-            [midx, 0, width],
-            [midy, 0, height],
-        )
-        rdw = (coords[0].ra.deg, coords[0].dec.deg, coords[1].separation(coords[2]).deg)
+    # Reuse the WCS from the source extraction step, which also means that we
+    # center on the same HDU that we indexed.
+
+    midx = info.width_pixels // 2
+    midy = info.height_pixels // 2
+    ra_axis, dec_axis = equatorial_axes(info.wcs)
+    world = info.wcs.pixel_to_world_values(
+        [midx, 0, info.width_pixels],
+        [midy, 0, info.height_pixels],
+    )
+    ra, dec = world[ra_axis], world[dec_axis]
+    rdw = (ra[0], dec[0], angular_separation_deg(ra[1], dec[1], ra[2], dec[2]))
 
     plot = Plotstuff(outformat='png', size=(800, 800), rdw=rdw)
     ind = plot.index
@@ -295,6 +517,77 @@ def plot_index(
     logger.debug('saved index image to `%s`', img_path)
 
 
+@contextmanager
+def unlimited_pil_pixels():
+    """
+    Temporarily disable PIL's decompression-bomb check. Like toasty, we need
+    this to open big mosaics.
+    """
+    old_max = pil_image.MAX_IMAGE_PIXELS
+
+    try:
+        pil_image.MAX_IMAGE_PIXELS = None
+        yield
+    finally:
+        pil_image.MAX_IMAGE_PIXELS = old_max
+
+
+def image_dimensions(path):
+    """
+    Get the ``(width, height)`` of an image file without decoding its pixels.
+    """
+    with unlimited_pil_pixels(), pil_image.open(path) as pilimg:
+        return pilimg.size
+
+
+def make_solver_image(rgb_path, solver_path, factor, pilimg=None):
+    """
+    Write a grayscale copy of an RGB image, block-averaged by *factor* along
+    each axis, for the solver to sourcefind. A pixel of the new image covers
+    pixels ``factor * i`` through ``factor * i + factor - 1`` of the original.
+
+    If *pilimg* is given, it should be the already-decoded contents of
+    *rgb_path*, and it is used instead of decoding the file again.
+
+    Returns False, without writing anything, if the file has more than 8 bits
+    per channel: converting it to 8-bit grayscale would clip it, while the
+    solver can read it natively.
+    """
+    with unlimited_pil_pixels(), pil_image.open(rgb_path) as fileimg:
+        if ImageMode.getmode(fileimg.mode).typestr[-2:] not in ('u1', 'b1'):
+            return False
+
+        if pilimg is None:
+            pilimg = fileimg
+
+        # Reduce first, so that the grayscale conversion works on the small
+        # image. PIL can't reduce palettized or bilevel images, though.
+        if pilimg.mode in ('1', 'P'):
+            pilimg = pilimg.convert('L')
+
+        small = pilimg.reduce(factor).convert('L')
+
+    small.save(solver_path, optimize=False)
+    return True
+
+
+def upsample_wcs(wcs, factor):
+    """
+    Modify *wcs*, a solution for an image made by :func:`make_solver_image`
+    with *factor*, in place so that it applies to the full-resolution image.
+    Downsampled pixel 1 is centered between full-resolution pixels 1 and
+    *factor* (1-based, as in FITS).
+    """
+    wcs.wcs.crpix = factor * (wcs.wcs.crpix - 0.5) + 0.5
+
+    if wcs.wcs.has_cd():
+        wcs.wcs.cd = wcs.wcs.cd / factor
+    else:
+        wcs.wcs.cdelt = wcs.wcs.cdelt / factor
+
+    wcs.wcs.set()
+
+
 @dataclass
 class AlignmentConfig(object):
     scale_range_factor: float = 2.0
@@ -305,72 +598,204 @@ class AlignmentConfig(object):
     "The CPU time limit for the solver, in seconds."
 
     downsample_factor: int = 2
-    "How much to downsample the source RGB image for sourcefinding"
+    """How much to downsample the source RGB image for sourcefinding. For images
+    with 8 bits per channel, we do this ourselves and hand the solver a small
+    grayscale copy. Images with deeper pixels are passed to the solver as-is,
+    with its ``--downsample`` option."""
 
     object_limit: int = 1000
     "Limit the number of objects processed from the RGB image"
 
-def go(
-    fits_paths = None,
-    rgb_path = None,
-    output_path = None,
-    tile_path = None,
+
+class LogRecordCollector(logging.Handler):
+    """
+    A logging handler that just saves up records, in a picklable form.
+    """
+    def __init__(self):
+        super(LogRecordCollector, self).__init__()
+        self.records = []
+
+    def emit(self, record):
+        # The arguments might not survive pickling, so format them now.
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        self.records.append(record)
+
+
+def capture_worker_logs(func, log_level, *args, **kwargs):
+    """
+    Call a function in a worker process, capturing the records it logs.
+
+    Returns a tuple ``(result, records)``, where *records* is a list of
+    LogRecords that the parent process can pass to ``logger.handle()``. The
+    *log_level* should be the parent's effective log level, since workers
+    don't necessarily inherit the parent's logging setup.
+    """
+    collector = LogRecordCollector()
+    saved_handlers = logger.handlers
+    saved_propagate = logger.propagate
+    saved_level = logger.level
+
+    logger.handlers = [collector]
+    logger.propagate = False
+    logger.setLevel(log_level)
+
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        logger.handlers = saved_handlers
+        logger.propagate = saved_propagate
+        logger.setLevel(saved_level)
+
+    return result, collector.records
+
+
+def index_reference_fits(
+    fits_num,
+    fits_path,
     work_dir = '',
     anet_bin_prefix = '',
+    index_cache_dir = None,
+    downsample = 1,
+    cfg = None,
 ):
     """
-    Do the whole thing.
+    Extract sources from one reference FITS file and build an Astrometry.Net
+    index from them.
+
+    If *index_cache_dir* is given, indexes are looked up in and saved to that
+    directory, keyed by the contents of the source table and the index
+    parameters, so that repeated runs on the same reference data don't need
+    to rebuild them. *downsample* is passed to :func:`source_extract_fits`.
+
+    Returns a tuple ``(index_fits, scale_low, scale_high)`` giving the path
+    of the index and the solver scale range that it implies, or None if
+    the file could not be used. This function is run in a worker process, so
+    it shouldn't depend on any other state of the main process.
     """
-    cfg = AlignmentConfig()
-    index_fits_list = []
-    scale_low = scale_high = None
+    if cfg is None:
+        cfg = AlignmentConfig()
 
-    for fits_num, fits_path in enumerate(fits_paths):
-        logger.info('Processing reference science image `%s` ...', fits_path)
+    logger.info('Processing reference science image `%s` ...', fits_path)
 
-        try:
-            info = source_extract_fits(fits_path, log_prefix='  ')
-        except Exception as e:
-            logger.warning('  Failed to extract sources from this file')
-            logger.warning('  Caused by: %s', e)
-            continue
+    try:
+        info = source_extract_fits(fits_path, log_prefix='  ', downsample=downsample)
+    except Exception as e:
+        logger.warning('  Failed to extract sources from this file')
+        logger.warning('  Caused by: %s', e)
+        return None
+
+    objects_fits = os.path.join(work_dir, f'objects{fits_num}.fits')
+    info.wcs_objects.writeto(objects_fits, overwrite=True)
 
-        objects_fits = os.path.join(work_dir, f'objects{fits_num}.fits')
-        info.wcs_objects.write(objects_fits, format='fits', overwrite=True)
+    # Generate the Astrometry.Net index, or reuse a cached one. The table
+    # writing is deterministic, so the file contents make a good key.
 
-        # Generate the Astrometry.Net index
+    index_fits = os.path.join(work_dir, f'index{fits_num}.fits')
+    index_log = os.path.join(work_dir, f'build-index-{fits_num}.log')
+    index_unique_key = str(fits_num)
+    cached_index_fits = None
 
-        index_fits = os.path.join(work_dir, f'index{fits_num}.fits')
-        index_log = os.path.join(work_dir, f'build-index-{fits_num}.log')
+    if index_cache_dir is not None:
+        hasher = hashlib.sha256()
 
+        with open(objects_fits, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                hasher.update(chunk)
+
+        preset = image_size_to_anet_preset(info.large_scale_deg)
+        key = f'{hasher.hexdigest()[:16]}-P{preset}-I{index_unique_key}'
+        cached_index_fits = os.path.join(index_cache_dir, f'index-{key}.fits')
+
+        if os.path.exists(cached_index_fits):
+            logger.info('  Using cached Astrometry.Net index `%s`', cached_index_fits)
+            index_fits = cached_index_fits
+
+    if index_fits != cached_index_fits:
         try:
             index_extracted_image(
                 objects_fits,
                 index_fits,
                 index_log = index_log,
                 extraction_info = info,
-                index_unique_key = str(fits_num),
+                index_unique_key = index_unique_key,
                 anet_bin_prefix = anet_bin_prefix,
                 log_prefix = '  ',
             )
         except Exception as e:
             logger.warning('  Failed to index this file')
             logger.warning('  Caused by: %s', e)
-            continue
+            return None
 
-        # Success!
+        if cached_index_fits is not None:
+            # Copy then rename, so that concurrent runs never see a partial file.
+            try:
+                os.makedirs(index_cache_dir, exist_ok=True)
+                temp_path = f'{cached_index_fits}.tmp{os.getpid()}'
+                shutil.copyfile(index_fits, temp_path)
+                os.replace(temp_path, cached_index_fits)
+            except Exception as e:
+                logger.warning('  Failed to save the index to the cache')
+                logger.warning('  Caused by: %s', e)
 
-        index_fits_list.append(index_fits)
+    # Success!
 
-        this_scale_low = info.width_deg * 60 / cfg.scale_range_factor  # units are image width in arcmin
-        this_scale_high = info.width_deg * 60 * cfg.scale_range_factor
+    scale_low = info.width_deg * 60 / cfg.scale_range_factor  # units are image width in arcmin
+    scale_high = info.width_deg * 60 * cfg.scale_range_factor
+    return index_fits, scale_low, scale_high
 
-        if scale_low is None:
-            scale_low = this_scale_low
-            scale_high = this_scale_high
-        else:
-            scale_low = min(scale_low, this_scale_low)
-            scale_high = max(scale_high, this_scale_high)
+
+def go(
+    fits_paths = None,
+    rgb_path = None,
+    output_path = None,
+    tile_path = None,
+    work_dir = '',
+    anet_bin_prefix = '',
+    index_cache_dir = None,
+    reference_downsample = 1,
+):
+    """
+    Do the whole thing.
+    """
+    cfg = AlignmentConfig()
+    index_fits_list = []
+    scale_low = scale_high = None
+
+    # The reference images are independent of each other, so we can process
+    # them in parallel. Each worker's log output is captured and replayed here,
+    # so that messages about different files don't get interleaved.
+
+    index_one = partial(
+        capture_worker_logs,
+        index_reference_fits,
+        logger.getEffectiveLevel(),
+        work_dir = work_dir,
+        anet_bin_prefix = anet_bin_prefix,
+        index_cache_dir = index_cache_dir,
+        downsample = reference_downsample,
+        cfg = cfg,
+    )
+    n_workers = min(len(fits_paths), os.cpu_count() or 1)
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for result, records in executor.map(index_one, range(len(fits_paths)), fits_paths):
+            for record in records:
+                logger.handle(record)
+
+            if result is None:
+                continue
+
+            index_fits, this_scale_low, this_scale_high = result
+            index_fits_list.append(index_fits)
+
+            if scale_low is None:
+                scale_low = this_scale_low
+                scale_high = this_scale_high
+            else:
+                scale_low = min(scale_low, this_scale_low)
+                scale_high = max(scale_high, this_scale_high)
 
     if not index_fits_list:
         raise Exception('cannot align: failed to index any of the input FITS files')
@@ -386,10 +811,75 @@ def go(
         for p in index_fits_list:
             print('index', p, file=f)
 
+    # Figure out our outputs. pyavm can't convert image formats, so if we've
+    # been asked to emit a tagged imagine in a format different than the
+    # image format, we need to do that conversion manually. We're not in a
+    # great position to be clever so we assess "format" from filename
+    # extensions.
+
+    in_name_pieces = os.path.splitext(os.path.basename(rgb_path))
+
+    if output_path is None:
+        output_path = in_name_pieces[0] + '_tagged' + in_name_pieces[1]
+
+    input_ext = in_name_pieces[1].lower()
+    output_ext = os.path.splitext(output_path)[1].lower()
+
+    # If it's available, we use libvips for format conversion, since it
+    # streams the image rather than decoding it all into memory.
+
+    try:
+        import pyvips
+    except (ImportError, OSError):
+        pyvips = None
+
+    # Only decode the full RGB image if we're going to tile it, or convert it
+    # without libvips. Otherwise all we need are its dimensions, which PIL can
+    # get from the file header.
+
+    need_convert = input_ext != output_ext
+
+    if tile_path is not None or (need_convert and pyvips is None):
+        img = ImageLoader().load_path(rgb_path)
+        img_width, img_height = img.width, img.height
+    else:
+        img = None
+        img_width, img_height = image_dimensions(rgb_path)
+
     # Solve our input image
 
     wcs_file = os.path.join(work_dir, 'solved.fits')
 
+    # Give the solver a small grayscale version of the image to work with, so
+    # that its own conversion pipeline, which can dominate its runtime on big
+    # RGB images, only has to handle that. This means that we decode the image
+    # here, but we reuse the decoded image if we've already loaded it for
+    # tiling or conversion. Images with more than 8 bits per channel are
+    # passed through for the solver to downsample itself, since we'd clip
+    # them. The scale bounds are in terms of the image width, so they don't
+    # change either way.
+
+    ds = cfg.downsample_factor
+    solver_path = rgb_path
+    solver_ds = 1  # downsampling that we applied, which the solution must undo
+    downsample_argv = []
+
+    if ds > 1:
+        small_path = os.path.join(work_dir, 'solver-input.png')
+        logger.info('Preparing downsampled image for the solver ...')
+
+        if make_solver_image(
+            rgb_path,
+            small_path,
+            ds,
+            pilimg = None if img is None else img.aspil(),
+        ):
+            solver_path = small_path
+            solver_ds = ds
+        else:
+            logger.info('  (image has high bit depth; leaving downsampling to the solver)')
+            downsample_argv = ['--downsample', str(ds)]
+
     # https://manpages.debian.org/testing/astrometry.net/solve-field.1.en.html
     argv = [
         anet_bin_prefix + 'solve-field',
@@ -404,35 +894,33 @@ def go(
         '-N', wcs_file,
         '--no-plots',
         '--no-tweak',
-        '--downsample', str(cfg.downsample_factor),
-        rgb_path,
+        *downsample_argv,
+        solver_path,
     ]
-    logger.debug('solve command: %s', ' '.join(argv))
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('solve command: %s', ' '.join(argv))
 
     solve_log = os.path.join(work_dir, 'solve-field.log')
     logger.info('Launching Astrometry.Net solver for `%s` ...', rgb_path)
 
-    try:
-        with open(solve_log, 'wb') as log:
-            subprocess.check_call(
-                argv,
-                stdout = log,
-                stderr = subprocess.STDOUT,
-                shell = False,
-            )
+    # Stream the solver output into the debug log as it arrives, so that long
+    # solves can be monitored. We also keep the tail in memory so that we can
+    # report it if something goes wrong, and tee everything into a log file
+    # for anyone inspecting the work directory.
+
+    solve_output = deque(maxlen=4096)
 
+    try:
+        run_and_log(argv, solve_log, output=solve_output, label='solve-field')
         assert os.path.exists(wcs_file), 'Astrometry.Net did not emit a solution file'
     except Exception as e:
         logger.error('  Failed to solve this image')
         logger.error('  Proximate Python exception: %s', e)
         logger.error('  Output from solve-field:')
 
-        try:
-            with open(solve_log, 'r') as f:
-                for line in f:
-                    logger.error('    %s', line.rstrip())
-        except Exception as sub_e:
-            logger.error('     [failed to read the log! error: %s]', sub_e)
+        for line in solve_output:
+            logger.error('    %s', line)
 
         raise
 
@@ -440,37 +928,48 @@ def go(
     #
     # TODO: map positive parity into both AVM and WWT metadata correctly.
 
-    img = ImageLoader().load_path(rgb_path)
+    wcs = WCS(fits.getheader(wcs_file, 0))
 
-    with fits.open(wcs_file) as hdul:
-        header = hdul[0].header
-        wcs = WCS(header)
+    # If we downsampled the image for the solver, the solution is in terms of
+    # the small image, so map it back to the full-resolution pixel grid.
 
-    hdwork = wcs.to_header()
-    hdwork['CRPIX2'] = img.height + 1 - hdwork['CRPIX2']
-    hdwork['PC1_2'] *= -1
-    hdwork['PC2_2'] *= -1
-    wcs = WCS(hdwork)
-    avm = AVM.from_wcs(wcs, shape=(img.height, img.width))
+    if solver_ds > 1:
+        upsample_wcs(wcs, solver_ds)
 
-    # Apply AVM
-    #
-    # pyavm can't convert image formats, so if we've been asked to emit a tagged
-    # imagine in a format different than the image format, we need to do that
-    # conversion manually. We're not in a great position to be clever so we
-    # assess "format" from filename extensions.
+    # Flip the parity by modifying the parsed WCS in place, rather than
+    # round-tripping through a header. The solver usually emits a CD matrix,
+    # but check.
 
-    in_name_pieces = os.path.splitext(os.path.basename(rgb_path))
+    wcs.wcs.crpix[1] = img_height + 1 - wcs.wcs.crpix[1]
 
-    if output_path is None:
-        output_path = in_name_pieces[0] + '_tagged' + in_name_pieces[1]
+    if wcs.wcs.has_cd():
+        wcs.wcs.cd[:, 1] *= -1
+    else:
+        wcs.wcs.pc[:, 1] *= -1
 
-    input_ext = in_name_pieces[1].lower()
-    output_ext = os.path.splitext(output_path)[1].lower()
+    wcs.wcs.set()
+    avm = AVM.from_wcs(wcs, shape=(img_height, img_width))
 
-    if input_ext != output_ext:
+    # Apply AVM
+
+    if need_convert:
         logger.info('Converting input image to create `%s`', output_path)
-        img.save(output_path, format=output_ext.replace('.', ''))
+
+        converted = False
+
+        if pyvips is not None:
+            try:
+                pyvips.Image.new_from_file(rgb_path, access='sequential').write_to_file(output_path)
+                converted = True
+            except pyvips.Error as e:
+                logger.warning('  libvips could not convert the image; falling back to PIL')
+                logger.warning('  Caused by: %s', e)
+
+        if not converted:
+            if img is None:
+                img = ImageLoader().load_path(rgb_path)
+
+            img.save(output_path, format=output_ext.replace('.', ''))
 
         logger.info('Adding AVM tags to `%s`', output_path)
         avm.embed(output_path, output_path)
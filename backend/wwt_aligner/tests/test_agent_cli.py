@@ -0,0 +1,148 @@
+# Copyright 2021 the .NET Foundation
+# Licensed under the MIT License
+
+import json
+import pytest
+
+from .. import agent_cli
+
+
+class TestPeelMetaArgs(object):
+    def test_none(self):
+        meta, rest = agent_cli.peel_meta_args(['go', '-o', 'out.png'])
+        assert meta == {
+            'analyze_args_mode': False,
+            'host_paths': None,
+            'container_paths': None,
+        }
+        assert rest == ['go', '-o', 'out.png']
+
+    def test_analyze_mode(self):
+        meta, rest = agent_cli.peel_meta_args(['--x-analyze-args-mode', 'go'])
+        assert meta['analyze_args_mode']
+        assert rest == ['go']
+
+    def test_equals_and_separate_values(self):
+        meta, rest = agent_cli.peel_meta_args([
+            '--x-host-path=/host/a',
+            '--x-container-path', '/container/a',
+            'go',
+        ])
+        assert meta['host_paths'] == ['/host/a']
+        assert meta['container_paths'] == ['/container/a']
+        assert rest == ['go']
+
+    def test_repeated(self):
+        meta, rest = agent_cli.peel_meta_args([
+            '--x-host-path', '/host/a',
+            '--x-container-path=/container/a',
+            '--x-host-path=/host/b',
+            '--x-container-path', '/container/b',
+            'serve-wtml',
+        ])
+        assert meta['host_paths'] == ['/host/a', '/host/b']
+        assert meta['container_paths'] == ['/container/a', '/container/b']
+        assert rest == ['serve-wtml']
+
+    def test_value_with_equals(self):
+        meta, _rest = agent_cli.peel_meta_args(['--x-host-path=/a=b', 'go'])
+        assert meta['host_paths'] == ['/a=b']
+
+    def test_stops_at_subcommand(self):
+        meta, rest = agent_cli.peel_meta_args([
+            '--x-analyze-args-mode',
+            'go',
+            '--x-host-path', '/host/a',
+        ])
+        assert meta['analyze_args_mode']
+        assert meta['host_paths'] is None
+        assert rest == ['go', '--x-host-path', '/host/a']
+
+    def test_missing_value(self, capsys):
+        with pytest.raises(SystemExit) as ei:
+            agent_cli.peel_meta_args(['--x-host-path'])
+
+        assert ei.value.code == 1
+        assert '--x-host-path requires a value' in capsys.readouterr().err
+
+
+def analyze(capsys, *args):
+    with pytest.raises(SystemExit) as ei:
+        agent_cli.entrypoint(['--x-analyze-args-mode'] + list(args))
+
+    assert ei.value.code == 100
+    return json.loads(capsys.readouterr().out)
+
+
+class TestAnalyzeArgs(object):
+    def test_go(self, capsys):
+        data = analyze(
+            capsys,
+            '--x-host-path=/h', '--x-container-path=/c',
+            'go',
+            '-o', 'out.png',
+            '--tile', 'tiles',
+            '--reference-downsample', '2',
+            'in.png',
+            'a.fits',
+            'b.fits',
+        )
+        assert data['version'] == agent_cli.ARGS_PROTOCOL_VERSION
+        assert data['published_ports'] == []
+        assert data['pieces'] == [
+            {'text': 'go'},
+            {'text': '--log=', 'incomplete': True},
+            {'text': 'default'},
+            {'text': '--output=', 'incomplete': True},
+            {'text': 'out.png', 'path_created': True},
+            {'text': '--tile=', 'incomplete': True},
+            {'text': 'tiles', 'path_created': True},
+            {'text': '--reference-downsample=2'},
+            {'text': 'in.png', 'path_pre_exists': True},
+            {'text': 'a.fits', 'path_pre_exists': True},
+            {'text': 'b.fits', 'path_pre_exists': True},
+        ]
+
+    def test_go_bad_downsample(self, capsys):
+        with pytest.raises(SystemExit) as ei:
+            agent_cli.entrypoint([
+                '--x-analyze-args-mode',
+                'go', '-o', 'out.png', '--reference-downsample', '0', 'in.png', 'a.fits',
+            ])
+
+        assert ei.value.code == 2
+        assert 'must be at least 1' in capsys.readouterr().err
+
+    def test_serve_wtml(self, capsys):
+        data = analyze(capsys, 'serve-wtml', '--port', '1234', 'index.wtml')
+        assert data['pieces'] == [
+            {'text': 'serve-wtml'},
+            {'text': '--log=', 'incomplete': True},
+            {'text': 'default'},
+            {'text': '--port=', 'incomplete': True},
+            {'text': '1234'},
+            {'text': 'index.wtml', 'path_pre_exists': True},
+        ]
+        assert data['published_ports'] == [
+            {'host_port': 1234, 'container_port': 8080},
+        ]
+
+    def test_diagnostic(self, capsys):
+        data = analyze(
+            capsys,
+            'diagnostic', 'plot-fits-index', '--anet-bin-prefix', '/anet/', 'a.fits',
+        )
+        assert data['pieces'] == [
+            {'text': 'diagnostic'},
+            {'text': '--log=', 'incomplete': True},
+            {'text': 'default'},
+            {'text': 'plot-fits-index'},
+            {'text': '--anet-bin-prefix=/anet/'},
+            {'text': 'a.fits', 'path_pre_exists': True},
+        ]
+
+        data = analyze(capsys, 'diagnostic', 'plot-fits-sources', 'a.fits')
+        assert data['pieces'][3:] == [
+            {'text': 'plot-fits-sources'},
+            {'text': 'a.fits', 'path_pre_exists': True},
+        ]
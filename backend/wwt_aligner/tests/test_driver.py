@@ -0,0 +1,87 @@
+# Copyright 2021 the .NET Foundation
+# Licensed under the MIT License
+
+import numpy as np
+import pytest
+
+from .. import driver
+
+
+class TestAnetPreset(object):
+    @pytest.mark.parametrize('preset', range(driver.ANET_PRESET_MIN + 1, driver.ANET_PRESET_MAX + 1))
+    def test_thresholds(self, preset):
+        edge = 2.0 ** ((preset - 5) / 2)
+        assert driver.image_size_to_anet_preset(edge) == preset
+        assert driver.image_size_to_anet_preset(np.nextafter(edge, 0)) == preset - 1
+
+    def test_matches_log_formula(self):
+        # The table lookup replaced this direct calculation.
+        for size_deg in np.geomspace(2e-3, 2e3, 1001):
+            expected = int(np.floor(5 + 2 * np.log2(size_deg)))
+            expected = min(max(expected, driver.ANET_PRESET_MIN), driver.ANET_PRESET_MAX)
+            assert driver.image_size_to_anet_preset(size_deg) == expected
+
+    def test_clamped(self):
+        assert driver.image_size_to_anet_preset(1e-6) == driver.ANET_PRESET_MIN
+        assert driver.image_size_to_anet_preset(1e6) == driver.ANET_PRESET_MAX
+
+    def test_integer(self):
+        assert type(driver.image_size_to_anet_preset(0.5)) is int
+
+
+def _solved_wcs(use_cd):
+    from astropy.wcs import WCS
+
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [150., 2.]
+    wcs.wcs.crpix = [200.5, 100.25]
+
+    if use_cd:
+        wcs.wcs.cd = [[-1e-3, 1e-4], [1e-4, 1e-3]]
+    else:
+        wcs.wcs.cdelt = [-1e-3, 1e-3]
+        wcs.wcs.pc = [[0.99, 0.1], [-0.1, 0.99]]
+
+    wcs.wcs.set()
+    return wcs
+
+
+@pytest.mark.parametrize('use_cd', [True, False])
+@pytest.mark.parametrize('factor', [2, 3])
+def test_upsample_wcs(use_cd, factor):
+    small = _solved_wcs(use_cd)
+    full = _solved_wcs(use_cd)
+    driver.upsample_wcs(full, factor)
+
+    # 0-based small pixel i covers full pixels factor*i ... factor*i + factor - 1.
+    sx = np.array([0., 17., 199.5, 399.])
+    sy = np.array([0., 250., 100., 3.])
+    fx = factor * sx + 0.5 * (factor - 1)
+    fy = factor * sy + 0.5 * (factor - 1)
+
+    s_ra, s_dec = small.pixel_to_world_values(sx, sy)
+    f_ra, f_dec = full.pixel_to_world_values(fx, fy)
+    np.testing.assert_allclose(f_ra, s_ra, rtol=0, atol=1e-10)
+    np.testing.assert_allclose(f_dec, s_dec, rtol=0, atol=1e-10)
+    assert full.wcs.has_cd() == use_cd
+
+
+def test_make_solver_image(tmp_path):
+    from PIL import Image
+
+    rgb = np.zeros((5, 7, 3), dtype=np.uint8)
+    rgb[:4, :6] = 200
+    Image.fromarray(rgb).save(tmp_path / 'rgb.png')
+
+    assert driver.make_solver_image(str(tmp_path / 'rgb.png'), str(tmp_path / 'small.png'), 2)
+
+    small = Image.open(tmp_path / 'small.png')
+    assert small.mode == 'L'
+    assert small.size == (4, 3)  # partial boxes at the edges are kept
+    assert np.asarray(small)[0, 0] == 200
+
+    deep = np.zeros((5, 7), dtype=np.uint16)
+    Image.fromarray(deep).save(tmp_path / 'deep.png')
+    assert not driver.make_solver_image(str(tmp_path / 'deep.png'), str(tmp_path / 'no.png'), 2)
+    assert not (tmp_path / 'no.png').exists()